@@ -1,14 +1,15 @@
+import io
 import os
-import time
-import schedule
-import requests
+import asyncio
+import aiohttp
 import tweepy
 import logging
+import time
 from datetime import datetime, UTC, timedelta
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
 from pathlib import Path
-from functools import wraps
-from time import sleep
+from functools import cache, wraps
 
 # Configure logging
 logging.basicConfig(
@@ -32,48 +33,171 @@ TWITTER_ACCESS_TOKEN = os.environ.get('TWITTER_ACCESS_TOKEN')
 TWITTER_ACCESS_TOKEN_SECRET = os.environ.get('TWITTER_ACCESS_TOKEN_SECRET')
 GRAFANA_TOKEN = os.environ.get('GRAFANA_TOKEN')
 
-# Verify all required credentials are available
-if not all([TWITTER_API_KEY, TWITTER_API_SECRET, TWITTER_ACCESS_TOKEN, TWITTER_ACCESS_TOKEN_SECRET, GRAFANA_TOKEN]):
-    logging.error("Missing required environment variables!")
-    raise Exception("Missing required environment variables. Please ensure all credentials are set either in .env file or system environment.")
+# Grafana panel render settings, only the panel and time range change per call
+GRAFANA_URL = "https://dashboard.notrustverify.ch/render/d-solo/MggjRL1Vz/overall-stats"
+BASE_PARAMS = {
+    "width": "720",
+    "height": "480",
+    "tz": "utc"
+}
+GRAFANA_HEADERS = {"Authorization": f"Bearer {GRAFANA_TOKEN}"}
+
+# Month names for the tweet text, independent of the container's locale
+MONTHS = (
+    "January", "February", "March", "April", "May", "June",
+    "July", "August", "September", "October", "November", "December"
+)
+
+# (panelId, var-coinbase) of each panel attached to the daily tweet
+PANELS = (("8", "false"),)
+# Twitter allows at most 4 images per tweet
+MAX_MEDIA_PER_TWEET = 4
+
+# Network timeouts in seconds, so a hung connection fails fast and gets retried
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+@cache
+def _get_clients():
+    """
+    Verify the credentials and build the Twitter clients.
+    
+    Built on first use and reused across retries and daily runs, so the
+    module can be imported without credentials.
+    
+    Returns:
+        tuple: The API v2 client and the API v1.1 client for media upload
+    """
+    # Verify all required credentials are available
+    if not all([TWITTER_API_KEY, TWITTER_API_SECRET, TWITTER_ACCESS_TOKEN, TWITTER_ACCESS_TOKEN_SECRET, GRAFANA_TOKEN]):
+        logging.error("Missing required environment variables!")
+        raise Exception("Missing required environment variables. Please ensure all credentials are set either in .env file or system environment.")
+    
+    logging.info("Environment variables loaded successfully!")
+    
+    client = tweepy.Client(
+        consumer_key=TWITTER_API_KEY,
+        consumer_secret=TWITTER_API_SECRET,
+        access_token=TWITTER_ACCESS_TOKEN,
+        access_token_secret=TWITTER_ACCESS_TOKEN_SECRET
+    )
+    
+    # API v1.1 for media upload
+    auth = tweepy.OAuth1UserHandler(
+        TWITTER_API_KEY,
+        TWITTER_API_SECRET,
+        TWITTER_ACCESS_TOKEN,
+        TWITTER_ACCESS_TOKEN_SECRET
+    )
+    api = tweepy.API(auth, timeout=READ_TIMEOUT)
+    return client, api
+
+# Grafana session, created lazily since aiohttp needs a running event loop,
+# along with the loop it is bound to
+_grafana_session = None
+_grafana_session_loop = None
+
+def get_grafana_session():
+    """Return the shared Grafana session, creating it on first use in each event loop"""
+    global _grafana_session, _grafana_session_loop
+    loop = asyncio.get_running_loop()
+    if _grafana_session is None or _grafana_session.closed or _grafana_session_loop is not loop:
+        _grafana_session_loop = loop
+        _grafana_session = aiohttp.ClientSession(
+            headers=GRAFANA_HEADERS,
+            timeout=aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+        )
+    return _grafana_session
+
+def get_status_code(e):
+    """Return the HTTP status code carried by an exception, if any"""
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status
+    if isinstance(e, tweepy.errors.HTTPException):
+        return e.response.status_code
+    return None
 
-logging.info("Environment variables loaded successfully!")
+def get_rate_limit_delay(e):
+    """Return the seconds to wait advertised by a rate limit response, if any"""
+    if isinstance(e, tweepy.errors.TooManyRequests):
+        # Twitter sends the unix time at which the rate limit window resets
+        reset = e.response.headers.get("x-rate-limit-reset")
+        if reset and reset.isdigit():
+            return max(1, int(reset) - time.time())
+    elif isinstance(e, aiohttp.ClientResponseError) and e.headers:
+        # Retry-After is either a number of seconds or an HTTP date
+        retry_after = e.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return max(1, int(retry_after))
+        if retry_after:
+            try:
+                return max(1, (parsedate_to_datetime(retry_after) - datetime.now(UTC)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return None
 
-def retry_with_backoff(max_retries=3, initial_delay=1, max_delay=60, backoff_factor=2):
+def retry_with_backoff(max_retries=3, initial_delay=1, max_delay=60, backoff_factor=2,
+                       max_rate_limit_delay=15 * 60, idempotent=True):
     """
-    Retry decorator with exponential backoff.
+    Retry decorator with exponential backoff for coroutine functions.
+    
+    Rate limit responses wait for the advertised reset time instead, falling
+    back to the exponential delay when the response doesn't carry one. A reset
+    further away than max_rate_limit_delay is re-raised without retrying.
+    
+    Non-idempotent calls are only retried on rate limit responses, since any
+    other failure (timeout, server error, dropped connection) may happen after
+    the request already took effect.
     
     Args:
         max_retries (int): Maximum number of retries before giving up
         initial_delay (int): Initial delay in seconds
         max_delay (int): Maximum delay in seconds
         backoff_factor (int): Factor to multiply delay by after each failure
+        max_rate_limit_delay (int): Maximum delay in seconds to wait for a rate limit reset
+        idempotent (bool): Whether the call is safe to repeat after an unknown outcome
     """
     def decorator(func):
         @wraps(func)
-        def wrapper(*args, **kwargs):
+        async def wrapper(*args, **kwargs):
             delay = initial_delay
             last_exception = None
             
             for retry in range(max_retries + 1):
                 try:
-                    return func(*args, **kwargs)
+                    return await func(*args, **kwargs)
                 except Exception as e:
                     last_exception = e
+                    # Client errors other than rate limits won't succeed on retry
+                    status_code = get_status_code(e)
+                    if status_code is not None and 400 <= status_code < 500 and status_code != 429:
+                        logging.error(f"Unrecoverable error, not retrying: {type(e).__name__}: {e}")
+                        raise
+                    # The request may have gone through, repeating it could duplicate it
+                    if not idempotent and status_code != 429:
+                        logging.error(f"Outcome unknown, not retrying: {type(e).__name__}: {e}")
+                        raise
                     if retry == max_retries:
-                        logging.error(f"Failed after {max_retries} retries: {str(e)}")
+                        logging.error(f"Failed after {max_retries} retries: {type(e).__name__}: {e}")
                         raise
                     
-                    # If it's a rate limit error, log specifically for that
-                    if isinstance(e, tweepy.errors.TooManyRequests) or (
-                        isinstance(e, requests.exceptions.RequestException) and 
-                        getattr(e.response, 'status_code', 0) == 429
-                    ):
+                    # If it's a rate limit error, wait until the limit resets
+                    rate_limit_delay = get_rate_limit_delay(e) if status_code == 429 else None
+                    if rate_limit_delay is not None:
+                        # Retrying before the reset would only hit the limit again
+                        if rate_limit_delay > max_rate_limit_delay:
+                            logging.error(f"Rate limit resets in {rate_limit_delay:.0f} seconds, not retrying")
+                            raise
+                        logging.warning(f"Rate limit hit, retrying in {rate_limit_delay:.0f} seconds...")
+                        await asyncio.sleep(rate_limit_delay)
+                        continue
+                    
+                    if status_code == 429:
                         logging.warning(f"Rate limit hit, retrying in {delay} seconds...")
                     else:
-                        logging.warning(f"Attempt {retry + 1} failed: {str(e)}. Retrying in {delay} seconds...")
+                        logging.warning(f"Attempt {retry + 1} failed: {type(e).__name__}: {e}. Retrying in {delay} seconds...")
                     
-                    sleep(delay)
+                    await asyncio.sleep(delay)
                     delay = min(delay * backoff_factor, max_delay)
             
             raise last_exception
@@ -81,93 +205,120 @@ def retry_with_backoff(max_retries=3, initial_delay=1, max_delay=60, backoff_fac
     return decorator
 
 @retry_with_backoff(max_retries=3, initial_delay=5)
-def fetch_image():
-    """Fetch the image from Grafana dashboard"""
-    # Calculate yesterday's date range
-    yesterday = datetime.now(UTC) - timedelta(days=1)
-    from_date = yesterday.replace(hour=0, minute=0, second=0, microsecond=0)
-    to_date = yesterday.replace(hour=23, minute=59, second=59, microsecond=999999)
-
-    url = "https://dashboard.notrustverify.ch/render/d-solo/MggjRL1Vz/overall-stats"
+async def render_panel(params):
+    """Render a panel on Grafana and return the image as an upload buffer"""
+    session = get_grafana_session()
+    # Raise an exception for bad status codes
+    async with session.get(GRAFANA_URL, params=params, raise_for_status=True) as response:
+        # Stream the body into the upload buffer instead of materializing it twice
+        image = io.BytesIO()
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            image.write(chunk)
+    image.seek(0)
+    return image
+
+async def fetch_image(day, panel_id, var_coinbase):
+    """Fetch a panel image covering the given UTC day from Grafana dashboard"""
+    iso_day = f"{day.year:04d}-{day.month:02d}-{day.day:02d}"
     params = {
-        "panelId": "8",
-        "var-coinbase": "false",
-        "from": from_date.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
-        "to": to_date.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
-        "width": "720",
-        "height": "480",
-        "tz": "utc"
-    }
-    headers = {
-        "Authorization": f"Bearer {GRAFANA_TOKEN}"
+        **BASE_PARAMS,
+        "panelId": panel_id,
+        "var-coinbase": var_coinbase,
+        "from": f"{iso_day}T00:00:00.000Z",
+        "to": f"{iso_day}T23:59:59.999Z"
     }
     
-    logging.info(f"Fetching data from {from_date} to {to_date}")
-    response = requests.get(url, params=params, headers=headers)
-    response.raise_for_status()  # Raise an exception for bad status codes
-    
-    image_path = "/app/data/panel.jpg"
-    with open(image_path, "wb") as f:
-        f.write(response.content)
-    logging.info(f"Image saved successfully to {image_path}")
-    return image_path
+    logging.info(f"Fetching panel {panel_id} from {params['from']} to {params['to']}")
+    image = await render_panel(params)
+    logging.info(f"Panel {panel_id} fetched successfully ({image.getbuffer().nbytes} bytes)")
+    return image
 
 @retry_with_backoff(max_retries=3, initial_delay=5)
-def post_to_twitter():
-    """Post the image to Twitter"""
-    logging.info("Initializing Twitter client")
-    # Initialize Twitter client
-    client = tweepy.Client(
-        consumer_key=TWITTER_API_KEY,
-        consumer_secret=TWITTER_API_SECRET,
-        access_token=TWITTER_ACCESS_TOKEN,
-        access_token_secret=TWITTER_ACCESS_TOKEN_SECRET
+async def upload_media(api, panel_id, image):
+    """Upload a panel image to Twitter and return the media"""
+    # A failed attempt may have consumed part of the buffer
+    image.seek(0)
+    return await asyncio.to_thread(api.media_upload, filename=f"panel-{panel_id}.jpg", file=image)
+
+@retry_with_backoff(max_retries=3, initial_delay=5, idempotent=False)
+async def create_tweet(client, text, media_ids):
+    """Post a tweet with the given media attached"""
+    # tweepy.Client has no timeout option, so bound the wait here. The thread
+    # may still post after a timeout, hence no retry on anything but a 429
+    return await asyncio.wait_for(
+        asyncio.to_thread(client.create_tweet, text=text, media_ids=media_ids),
+        timeout=CONNECT_TIMEOUT + READ_TIMEOUT
     )
+
+async def post_to_twitter(day=None, panels=PANELS):
+    """Post the panel images for a UTC day, yesterday by default, in a single tweet"""
+    day = day or (datetime.now(UTC) - timedelta(days=1)).date()
+    client, api = _get_clients()
+    if len(panels) > MAX_MEDIA_PER_TWEET:
+        raise ValueError(f"A tweet can hold at most {MAX_MEDIA_PER_TWEET} images, got {len(panels)} panels")
     
-    # Initialize API v1.1 for media upload
-    auth = tweepy.OAuth1UserHandler(
-        TWITTER_API_KEY,
-        TWITTER_API_SECRET,
-        TWITTER_ACCESS_TOKEN,
-        TWITTER_ACCESS_TOKEN_SECRET
-    )
-    api = tweepy.API(auth)
+    # Render all panels concurrently, Grafana rendering dominates the run time
+    images = await asyncio.gather(*(fetch_image(day, panel_id, var_coinbase) for panel_id, var_coinbase in panels))
     
-    # Fetch the image
-    image_path = fetch_image()
-    if not image_path:
-        raise Exception("Failed to fetch image")
-        
-    logging.info("Uploading media to Twitter")
-    # Upload media
-    media = api.media_upload(filename=image_path)
+    logging.info(f"Uploading {len(images)} media to Twitter")
+    media = await asyncio.gather(*(
+        upload_media(api, panel_id, image)
+        for (panel_id, _), image in zip(panels, images)
+    ))
     
-    # Get yesterday's date for the tweet with month name and day
-    yesterday = (datetime.now(UTC) - timedelta(days=1)).strftime("%B %d")
-    tweet_text = f"🔥 Daily $ALPH Burned - {yesterday}"
+    # Date for the tweet with month name and day
+    tweet_text = f"🔥 Daily $ALPH Burned - {MONTHS[day.month - 1]} {day.day:02d}"
     
     logging.info("Posting tweet")
-    client.create_tweet(text=tweet_text, media_ids=[media.media_id])
+    await create_tweet(client, tweet_text, [m.media_id for m in media])
     
     logging.info(f"Successfully posted tweet at {datetime.now(UTC)}")
 
+def next_run_time(now=None):
+    """Return the datetime of the next 00:01 UTC"""
+    now = now or datetime.now(UTC)
+    next_run = now.replace(hour=0, minute=1, second=0, microsecond=0)
+    if next_run <= now:
+        next_run += timedelta(days=1)
+    return next_run
+
+async def sleep_until(target):
+    """Sleep until the wall clock reaches target"""
+    # asyncio.sleep runs on the monotonic clock, which can drift from UTC
+    # over a day (NTP corrections, host suspend), so top up if woken early
+    while (remaining := (target - datetime.now(UTC)).total_seconds()) > 0:
+        await asyncio.sleep(remaining)
+
+async def runner():
+    """Sleep until 00:01 UTC, post, and repeat"""
+    try:
+        # Run the first post immediately
+        # logging.info("Running initial post...")
+        # await post_to_twitter()
+        
+        while True:
+            target = next_run_time()
+            logging.info(f"Next post scheduled at {target}")
+            await sleep_until(target)
+            try:
+                # Post the day that just ended, even if the wakeup ran late
+                await post_to_twitter((target - timedelta(days=1)).date())
+            except Exception as e:
+                logging.error(f"Daily post failed: {type(e).__name__}: {e}")
+    finally:
+        if _grafana_session is not None and _grafana_session_loop is asyncio.get_running_loop():
+            await _grafana_session.close()
+
 def main():
     """Main function to schedule and run the bot"""
     logging.info("Starting Twitter bot...")
-    
-    # Schedule the job to run at 00:01 UTC
-    schedule.every().day.at("00:01").do(post_to_twitter)
+    # Fail at startup rather than at the first scheduled post
+    _get_clients()
     logging.info("Scheduled daily post for 00:01 UTC")
     
-    # Run the first post immediately
-    # logging.info("Running initial post...")
-    # post_to_twitter()
-    
     # Keep the script running
     logging.info("Bot is now running. Waiting for scheduled tasks...")
-    while True:
-        schedule.run_pending()
-        time.sleep(60)
+    asyncio.run(runner())
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file